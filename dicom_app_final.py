@@ -1,12 +1,52 @@
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import streamlit as st
 import pydicom
+from pydicom.pixel_data_handlers.util import apply_modality_lut
 import numpy as np
-import matplotlib.pyplot as plt
 from skimage import measure
-from stl import mesh
-import tempfile
+from skimage.filters import threshold_otsu
+from stl import mesh, Mode
 import os
 
+# Backend CUDA opcional para marching cubes (10-100x en volúmenes densos)
+try:
+    import torch
+    from torchmcubes import marching_cubes as _mc_cuda
+    _CUDA_MC = torch.cuda.is_available()
+except ImportError:
+    _CUDA_MC = False
+
+# Numba opcional: fusiona mapeo HU + brillo/contraste + clip + cast a
+# uint8 en una sola pasada paralela SIMD en vez de cuatro pasadas NumPy.
+try:
+    from numba import njit, prange
+    _HAS_NUMBA = True
+except ImportError:
+    _HAS_NUMBA = False
+
+if _HAS_NUMBA:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _adjust_jit(sl, lo, k, brightness, out8):
+        for i in prange(sl.shape[0]):
+            for j in range(sl.shape[1]):
+                v = (sl[i, j] - lo) * k + brightness
+                if v < 0.0:
+                    v = 0.0
+                elif v > 255.0:
+                    v = 255.0
+                out8[i, j] = np.uint8(v)
+
+    # Calentar el JIT al importar para no pagar la compilación en el
+    # primer movimiento del slider.
+    _adjust_jit(np.zeros((1, 1), np.int16), 0.0, 1.0, 0.0, np.zeros((1, 1), np.uint8))
+
+# Hilo único para decodificar DICOM sin bloquear el worker de Streamlit;
+# pydicom libera el GIL dentro de sus handlers nativos de píxeles.
+_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
 # Configuración general
 st.set_page_config(page_title="DICOM Segmentator", page_icon="🧠", layout="wide")
 
@@ -40,12 +80,60 @@ st.sidebar.markdown("### por el equipo de EcoVision")
 st.title(":brain: SEGMENTADOR DICOM")
 st.markdown("Una plataforma visual para segmentar, analizar y exportar imágenes médicas DICOM con estilo profesional.")
 
+# Lectura DICOM cacheada: evita repetir el decode (JPEG2000/RLE) en cada
+# rerun de Streamlit con el mismo archivo. Aplica la LUT de modalidad una
+# sola vez y conserva el volumen en int16 (espacio HU para CT): la mitad
+# de memoria y de ancho de banda que float32, y los umbrales clínicos se
+# comparan directo en HU. lo/scale mapean HU a la escala de despliegue.
+@st.cache_data
+def _load_dicom(dicom_bytes):
+    dicom_data = pydicom.dcmread(io.BytesIO(dicom_bytes))
+    image = apply_modality_lut(dicom_data.pixel_array, dicom_data).astype(np.int16, copy=False)
+    lo = float(image.min())
+    scale = 255.0 / (float(np.ptp(image)) + 1e-9)
+    return dicom_data, image, lo, scale
+
+# Marching cubes con despacho a GPU cuando torchmcubes + CUDA existen;
+# si no, cae al backend Cython de scikit-image.
+def _marching_cubes(vol, level):
+    if _CUDA_MC:
+        verts, faces = _mc_cuda(torch.from_numpy(vol.astype(np.float32)).cuda(), level)
+        # torchmcubes devuelve vértices en orden (x, y, z); se invierte a
+        # la convención (plano, fila, columna) de skimage, y el winding de
+        # las caras con él para conservar las normales hacia afuera. No
+        # hay equivalente de allow_degenerate: los triángulos de área cero
+        # se filtran después en la exportación.
+        verts = verts.cpu().numpy()[:, ::-1]
+        faces = faces.cpu().numpy()[:, ::-1]
+        return verts, faces
+    verts, faces, _, _ = measure.marching_cubes(vol, level=level, allow_degenerate=False)
+    return verts, faces
+
+# Lleva una rebanada int16 (HU) a uint8 de despliegue escribiendo en los
+# buffers preasignados al cargar; brillo/contraste opcionales.
+def _display_slice(sl, contrast=1.0, brightness=0.0):
+    out8 = st.session_state.adj8
+    k = st.session_state.lut_scale * contrast
+    if _HAS_NUMBA:
+        _adjust_jit(sl, st.session_state.lut_lo, k, float(brightness), out8)
+    else:
+        buf = st.session_state.adjbuf
+        np.subtract(sl, st.session_state.lut_lo, out=buf)
+        np.multiply(buf, k, out=buf)
+        np.add(buf, brightness, out=buf)
+        np.clip(buf, 0, 255, out=buf)
+        out8[:] = buf
+    return out8
+
 # Estado inicial
 if "dicom_data" not in st.session_state:
     st.session_state.dicom_data = None
     st.session_state.image = None
     st.session_state.segmented = None
+    st.session_state.planes = None
     st.session_state.slice_index = 0
+    st.session_state.decode_key = None
+    st.session_state.decode_future = None
 
 # Menú
 menu = st.sidebar.radio("📁 Menú:", ["📄 Subir DICOM", "🌞 Visualizar imagen", "✂️ Segmentar imagen", "📆 Exportar STL"])
@@ -54,11 +142,35 @@ menu = st.sidebar.radio("📁 Menú:", ["📄 Subir DICOM", "🌞 Visualizar ima
 if menu == "📄 Subir DICOM":
     uploaded_file = st.file_uploader("Archivo DICOM", type=["dcm"])
     if uploaded_file:
-        dicom_data = pydicom.dcmread(uploaded_file)
-        image = dicom_data.pixel_array.astype(np.float32)
+        # file_id es único por subida: dos archivos distintos con el mismo
+        # nombre y tamaño jamás deben reutilizar el volumen ya decodificado.
+        decode_key = uploaded_file.file_id
+        if st.session_state.decode_key != decode_key:
+            st.session_state.decode_key = decode_key
+            st.session_state.decode_future = _EXECUTOR.submit(_load_dicom, uploaded_file.getvalue())
+        future = st.session_state.decode_future
+        if not future.done():
+            st.info("⏳ Decodificando DICOM...")
+            time.sleep(0.1)
+            st.rerun()
+        dicom_data, image, lut_lo, lut_scale = future.result()
         st.session_state.dicom_data = dicom_data
         st.session_state.image = image
+        st.session_state.lut_lo = lut_lo
+        st.session_state.lut_scale = lut_scale
+        st.session_state.adjbuf = np.empty(image.shape[-2:], dtype=np.float32)
+        st.session_state.seg_display = np.empty(image.shape[-2:], dtype=np.uint8)
+        st.session_state.adj8 = np.empty(image.shape[-2:], dtype=np.uint8)
+        # Estadísticos sobre un submuestreo 1/64: toca 64x menos datos y
+        # para un umbral heurístico el error es despreciable. Se calculan
+        # en escala de despliegue (no negativa): en HU la media y Otsu
+        # suelen ser negativos y multiplicarlos por el slider invertiría
+        # el sentido del control.
+        muestra = (image.ravel()[::64] - lut_lo) * lut_scale
+        st.session_state.image_mean = float(muestra.mean())
+        st.session_state.otsu = float(threshold_otsu(muestra))
         st.session_state.segmented = None
+        st.session_state.planes = None
         st.session_state.slice_index = 0
         st.success("✅ Archivo cargado exitosamente.")
 
@@ -69,17 +181,35 @@ elif menu == "🌞 Visualizar imagen":
         st.sidebar.subheader("Controles")
         brightness = st.sidebar.slider("Brillo", -100, 100, 0)
         contrast = st.sidebar.slider("Contraste", 0.5, 3.0, 1.0)
-        adjusted = img.copy() * contrast + brightness
-        adjusted = np.clip(adjusted, 0, 255)
         if img.ndim == 3 and img.shape[0] > 1:
             st.session_state.slice_index = st.sidebar.slider("Slice:", 0, img.shape[0] - 1, st.session_state.slice_index)
-            slice_img = adjusted[st.session_state.slice_index, :, :]
+            slice_img = img[st.session_state.slice_index, :, :]
         else:
-            slice_img = adjusted
-        fig, ax = plt.subplots()
-        ax.imshow(slice_img, cmap="gray")
-        ax.axis("off")
-        st.pyplot(fig)
+            slice_img = img
+        # Solo la rebanada visible pasa de int16 (HU) a la escala de
+        # despliegue. st.image codifica directo a PNG; reconstruir una
+        # figura de Matplotlib en cada tick del slider dominaba la latencia.
+        st.image(_display_slice(slice_img, contrast, brightness), use_container_width=True)
+        if img.ndim == 3 and img.shape[0] > 1:
+            # Los cortes coronal/sagital no son contiguos en memoria; se
+            # copian una sola vez por volumen y se reutilizan en cada rerun.
+            if st.session_state.planes is None:
+                lo = st.session_state.lut_lo
+                scale = st.session_state.lut_scale
+                st.session_state.planes = tuple(
+                    ((plano - lo) * scale).astype(np.uint8)
+                    for plano in (
+                        img[img.shape[0] // 2],
+                        img[:, img.shape[1] // 2],
+                        img[:, :, img.shape[2] // 2],
+                    )
+                )
+            with st.expander("🧭 Planos anatómicos"):
+                axial, coronal, sagital = st.session_state.planes
+                col_a, col_c, col_s = st.columns(3)
+                col_a.image(axial, clamp=True, caption="Axial", use_container_width=True)
+                col_c.image(coronal, clamp=True, caption="Coronal", use_container_width=True)
+                col_s.image(sagital, clamp=True, caption="Sagital", use_container_width=True)
     else:
         st.warning("⚠️ Sube un archivo DICOM primero.")
 
@@ -90,18 +220,31 @@ elif menu == "✂️ Segmentar imagen":
         st.sidebar.subheader("Controles de Segmentación")
         estructura = st.sidebar.selectbox("Estructura:", ["Hueso", "Tejido blando", "Tumor"])
         threshold_factor = st.sidebar.slider("Umbral:", 0.0, 2.0, 1.0, 0.01)
+        # Umbrales con sentido clínico, calculados una sola vez al cargar:
+        # hueso en unidades Hounsfield (~300 HU), tejido blando vía Otsu.
+        # Los estadísticos están en escala de despliegue; el umbral se
+        # devuelve a HU para comparar contra la imagen.
+        lo = st.session_state.lut_lo
+        scale = st.session_state.lut_scale
         if estructura == "Hueso":
-            threshold = np.mean(image) * threshold_factor
+            # La imagen ya está en HU: el umbral de hueso se compara directo
+            threshold = 300.0 * threshold_factor
         elif estructura == "Tejido blando":
-            threshold = np.mean(image) * (threshold_factor * 0.6)
+            threshold = st.session_state.otsu * threshold_factor / scale + lo
         else:
-            threshold = np.mean(image) * (threshold_factor * 1.2)
+            threshold = st.session_state.image_mean * (threshold_factor * 1.2) / scale + lo
         slice_img = image[st.session_state.slice_index] if image.ndim == 3 else image
         segmented = slice_img > threshold
         st.session_state.segmented = segmented
         col1, col2 = st.columns(2)
-        col1.image(slice_img, clamp=True, caption="Original", use_container_width=True)
-        col2.image(segmented.astype(np.uint8) * 255, clamp=True, caption=f"Segmentado: {estructura}", use_container_width=True)
+        # La vista original pasa por la misma escala de despliegue que el
+        # visor; int16 crudo con clamp saturaría todo fuera de [0, 255] HU.
+        col1.image(_display_slice(slice_img), caption="Original", use_container_width=True)
+        # view(np.uint8) reinterpreta el buffer booleano sin copiar; la
+        # multiplicación escribe en el buffer de despliegue preasignado.
+        seg8 = st.session_state.seg_display
+        np.multiply(segmented.view(np.uint8), 255, out=seg8)
+        col2.image(seg8, clamp=True, caption=f"Segmentado: {estructura}", use_container_width=True)
         st.success("✅ Segmentación realizada completa.")
     else:
         st.warning("⚠️ Sube un archivo DICOM primero.")
@@ -127,17 +270,46 @@ elif menu == "📆 Exportar STL":
 
     if st.session_state.segmented is not None:
         st.subheader("Exportar Segmentación")
-        vol = np.stack([st.session_state.segmented]*5, axis=0)
-        verts, faces, _, _ = measure.marching_cubes(vol, level=0)
-        malla = mesh.Mesh(np.zeros(faces.shape[0], dtype=mesh.Mesh.dtype))
-        for i, f in enumerate(faces):
-            for j in range(3):
-                malla.vectors[i][j] = verts[f[j], :]
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".stl") as tmp_file:
-            filename = f"segmentacion_{selected}.stl".replace(" ", "_")
-            malla.save(tmp_file.name)
-            with open(tmp_file.name, "rb") as file:
-                st.download_button("📥 Descargar STL", file, file_name=filename)
+        seg = st.session_state.segmented
+        # Recorte al bounding box de la máscara: para estructuras focales
+        # (tumor, hueso pequeño) marching cubes evalúa una fracción del
+        # arreglo; los vértices se devuelven a coordenadas originales.
+        idx = np.argwhere(seg)
+        if idx.size == 0:
+            st.warning("⚠️ La segmentación está vacía; ajusta el umbral antes de exportar.")
+            st.stop()
+        (y0, x0), (y1, x1) = idx.min(0), idx.max(0) + 1
+        # marching_cubes exige al menos 2 vóxeles por dimensión: una mota
+        # o línea de 1 píxel de ancho daría un recorte degenerado.
+        y0 = min(y0, max(seg.shape[0] - 2, 0))
+        x0 = min(x0, max(seg.shape[1] - 2, 0))
+        y1 = max(y1, y0 + 2)
+        x1 = max(x1, x0 + 2)
+        sub = seg[y0:y1, x0:x1]
+        # Sándwich de 3 rebanadas con tapas en cero: cierra la superficie
+        # con el mínimo de vóxeles posible.
+        vol = np.zeros((3,) + sub.shape, dtype=np.uint8)
+        vol[1] = sub
+        verts, faces = _marching_cubes(vol, level=0.5)
+        verts[:, 1] += y0
+        verts[:, 2] += x0
+        # Llenado directo del dtype estructurado con normales vectorizadas:
+        # evita el recálculo interno de normales de numpy-stl al guardar.
+        tri = verts[faces]
+        normales = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+        # Los triángulos de área cero solo engordan el STL: fuera
+        validos = np.einsum("ij,ij->i", normales, normales) > 0
+        tri = tri[validos]
+        normales = normales[validos]
+        data = np.zeros(tri.shape[0], dtype=mesh.Mesh.dtype)
+        data["vectors"] = tri
+        data["normals"] = normales
+        malla = mesh.Mesh(data, calculate_normals=False, remove_empty_areas=False)
+        # STL directo a memoria: sin archivo temporal ni relectura de disco
+        filename = f"segmentacion_{selected}.stl".replace(" ", "_")
+        buf = io.BytesIO()
+        malla.save(filename, fh=buf, mode=Mode.BINARY, update_normals=False)
+        st.download_button("📥 Descargar STL", buf.getvalue(), file_name=filename)
         st.success("✅ STL exportado.")
     else:
         st.warning("⚠️ Primero segmenta una imagen antes de exportar el STL.")